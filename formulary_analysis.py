@@ -1,16 +1,187 @@
+import os
+import tempfile
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# The only formulary columns the analysis uses, with explicit types so the
+# pyarrow parser skips type inference. Other columns are never read.
+# NDC is read as a string and converted to uint64, and the _YN flags are
+# converted to bool, when the text file is parsed.
+FORMULARY_DTYPES = {
+    'NDC': 'string[pyarrow]',
+    'FORMULARY_ID': 'category',
+    'TIER_LEVEL_VALUE': 'int8',
+    'PRIOR_AUTHORIZATION_YN': 'category',
+    'STEP_THERAPY_YN': 'category'
+}
+
+def parquet_path(file_path):
+    """
+    Path of the Parquet copy of a formulary text file (written alongside it).
+    """
+    return os.fspath(file_path) + '.parquet'
+
+# Parquet schema metadata key holding the source_stamp of the text file a
+# Parquet copy was written from
+SOURCE_STAMP_KEY = b'source_stamp'
+
+def source_stamp(file_path):
+    """
+    Size and modification time (in ns) of a text file, as stored in its
+    Parquet copy. Extracting the archives keeps their timestamps, so a
+    re-extracted file can be older than its Parquet copy; comparing for
+    equality rather than age catches that.
+    """
+    stat = os.stat(file_path)
+    return f'{stat.st_size}:{stat.st_mtime_ns}'.encode()
+
+def parquet_is_current(file_path):
+    """
+    True if the Parquet copy of file_path exists and was written from the
+    file as it is now.
+    """
+    try:
+        metadata = pq.read_schema(parquet_path(file_path)).metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        # Missing, or unreadable (e.g. cut short by an interrupted write)
+        return False
+    return metadata.get(SOURCE_STAMP_KEY) == source_stamp(file_path)
+
+def write_parquet(table, file_path, stamp, **write_options):
+    """
+    Writes table as the Parquet copy of file_path, recording stamp (the
+    source_stamp taken before file_path was read). The table goes to a
+    temporary file in the same directory that is then renamed over the
+    copy, so an interrupted conversion never leaves a partial copy behind.
+    """
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), SOURCE_STAMP_KEY: stamp})
+    target = parquet_path(file_path)
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(target) + '.', suffix='.tmp', dir=os.path.dirname(target))
+    os.close(fd)
+    try:
+        pq.write_table(table, temp_path, **write_options)
+        os.replace(temp_path, target)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def write_formulary_parquet(file_path, row_group_size=100_000):
+    """
+    One-time conversion of a formulary text file to Parquet, sorted by NDC.
+    Sorting keeps each row group's NDC min/max tight, so reading a single
+    NDC can skip nearly every row group.
+    """
+    # Stamp before reading, so a file replaced mid-conversion reads as stale
+    stamp = source_stamp(file_path)
+    df = _read_formulary_text(file_path).sort_values('NDC', kind='stable')
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    write_parquet(table, file_path, stamp, row_group_size=row_group_size, compression='zstd')
+
+def read_formulary(file_path, target_ndc=None, target_ndcs=None):
+    """
+    Reads a formulary file into memory once.
+    NDCs are stored as uint64 so leading zeros don't matter when filtering,
+    and the PA/ST flags are stored as bool so percentages are plain means.
+    
+    If an up-to-date Parquet copy from write_formulary_parquet exists it is
+    read instead of the text file. Passing target_ndc returns only that
+    NDC's rows, which with Parquet skips the row groups that can't contain it;
+    passing a list as target_ndcs does the same for several NDCs in one scan.
+    """
+    filters = None
+    if target_ndc is not None:
+        filters = [('NDC', '==', int(target_ndc))]
+    elif target_ndcs is not None:
+        filters = [('NDC', 'in', [int(ndc) for ndc in target_ndcs])]
+
+    if parquet_is_current(file_path):
+        df = pq.read_table(parquet_path(file_path), columns=list(FORMULARY_DTYPES), filters=filters).to_pandas()
+        df['FORMULARY_ID'] = df['FORMULARY_ID'].astype('category')
+        return df
+    
+    df = _read_formulary_text(file_path)
+    if target_ndc is not None:
+        df = filter_ndc(df, target_ndc)
+    elif target_ndcs is not None:
+        wanted = np.array([int(ndc) for ndc in target_ndcs], dtype=np.uint64)
+        df = df[df['NDC'].isin(wanted)].reset_index(drop=True)
+    return df
+
+def _read_formulary_text(file_path):
+    """
+    Parses a pipe-delimited formulary text file into the FORMULARY_DTYPES layout.
+    """
+    df = pd.read_csv(file_path, delimiter='|', engine='pyarrow', usecols=list(FORMULARY_DTYPES), dtype=FORMULARY_DTYPES)
+    df['NDC'] = pd.to_numeric(df['NDC'], errors='coerce').fillna(0).astype('uint64')
+    for col in ('PRIOR_AUTHORIZATION_YN', 'STEP_THERAPY_YN'):
+        df[col] = (df[col] == 'Y').to_numpy()
+    return df
+
+# Row positions returned for NDCs that are missing from an index
+_NO_ROWS = np.empty(0, dtype=np.int64)
+
+def build_ndc_index(formulary_df):
+    """
+    Maps each NDC to the row positions where it appears, so repeated
+    per-NDC lookups are a dict hit instead of a full column scan.
+    """
+    return formulary_df.groupby('NDC', sort=False).indices
+
+def shared_category_dtype(column, *dfs):
+    """
+    Builds one categorical dtype covering the values of column in every given
+    DataFrame. Recoding each frame's column to it makes the category codes
+    line up, so merges and comparisons on the column work on integer codes.
+    """
+    # Categories can't be null; null rows just get code -1 and never match
+    categories = pd.Index(np.concatenate([np.asarray(df[column].dropna().unique()) for df in dfs])).unique()
+    return pd.CategoricalDtype(categories)
+
+def recode(values, dtype):
+    """
+    Returns values as a Categorical of dtype, with codes into dtype's categories.
+    
+    Don't use astype for this: pandas treats unordered dtypes with the same
+    categories in another order as equal, so astype leaves such a column
+    as it is and its codes keep pointing into the old category order.
+    """
+    return pd.Categorical(values, dtype=dtype)
+
+def same_categories(dtype, other):
+    """
+    True if both dtypes are categorical with the same categories in the same
+    order, i.e. their codes mean the same values (dtype equality doesn't
+    check the order; see recode).
+    """
+    return (
+        isinstance(dtype, pd.CategoricalDtype) and isinstance(other, pd.CategoricalDtype)
+        and dtype.categories.equals(other.categories)
+    )
+
+def ndc_rows(formulary_df, target_ndc, ndc_index=None):
+    """
+    Returns the row positions for a specific NDC in a loaded formulary DataFrame.
+    Handles NDC format with or without leading zeros.
+    Pass the result of build_ndc_index to skip the column scan.
+    """
+    if ndc_index is not None:
+        return ndc_index.get(np.uint64(int(target_ndc)), _NO_ROWS)
+    return np.flatnonzero(formulary_df['NDC'].to_numpy() == np.uint64(int(target_ndc)))
+
+def filter_ndc(formulary_df, target_ndc, ndc_index=None):
+    """
+    Filters an already loaded formulary DataFrame for a specific NDC.
+    """
+    return formulary_df.take(ndc_rows(formulary_df, target_ndc, ndc_index))
 
 def load_formulary_data(file_path, target_ndc):
     """
     Loads and filters formulary data for a specific NDC.
     Handles NDC format with or without leading zeros.
     """
-    df = pd.read_csv(file_path, delimiter='|')
-    # Convert target_ndc to string, ensuring it's properly formatted
-    target_ndc = str(target_ndc).zfill(11)
-    # Convert DataFrame NDC column to string and pad with zeros
-    df['NDC'] = df['NDC'].astype(str).str.zfill(11)
-    return df[df['NDC'] == target_ndc]
+    return read_formulary(file_path, target_ndc)
 
 def analyze_ndc_stats(file_path, target_ndc):
     """
@@ -23,9 +194,18 @@ def analyze_ndc_stats(file_path, target_ndc):
     Returns:
         dict: Dictionary containing prior auth %, average tier, and step therapy %
     """
-    ndc_data = load_formulary_data(file_path, target_ndc)
+    return analyze_ndc_stats_df(read_formulary(file_path, target_ndc), target_ndc)
+
+def analyze_ndc_stats_df(formulary_df, target_ndc, ndc_index=None):
+    """
+    Same as analyze_ndc_stats, but operates on a formulary DataFrame that
+    has already been loaded with read_formulary (and optionally indexed
+    with build_ndc_index).
+    """
+    # Gather just the needed columns at the NDC's rows instead of building a filtered frame
+    rows = ndc_rows(formulary_df, target_ndc, ndc_index)
     
-    if len(ndc_data) == 0:
+    if len(rows) == 0:
         return {
             'ndc': target_ndc,
             'prior_auth_percent': 0,
@@ -36,30 +216,46 @@ def analyze_ndc_stats(file_path, target_ndc):
         }
     
     # Calculate statistics
-    prior_auth_percent = (ndc_data['PRIOR_AUTHORIZATION_YN'] == 'Y').mean() * 100
-    avg_tier = ndc_data['TIER_LEVEL_VALUE'].mean()
-    step_therapy_percent = (ndc_data['STEP_THERAPY_YN'] == 'Y').mean() * 100
+    avg_tier, prior_auth_percent, step_therapy_percent = requirement_stats(
+        formulary_df['TIER_LEVEL_VALUE'].to_numpy()[rows],
+        formulary_df['PRIOR_AUTHORIZATION_YN'].to_numpy()[rows],
+        formulary_df['STEP_THERAPY_YN'].to_numpy()[rows]
+    )
     
     return {
         'ndc': target_ndc,
         'prior_auth_percent': round(prior_auth_percent, 2),
         'avg_tier': round(avg_tier, 2),
         'step_therapy_percent': round(step_therapy_percent, 2),
-        'count': len(ndc_data),
-        'formularies': set(ndc_data['FORMULARY_ID'].unique())
+        'count': len(rows),
+        'formularies': set(formulary_df['FORMULARY_ID'].array.take(rows).unique())
     }
 
+def requirement_stats(tier, prior_auth, step_therapy):
+    """
+    Average tier plus prior auth and step therapy percentages, computed
+    directly on the raw column arrays (the flags are bool, so their sum
+    is the number of rows requiring them). Arrays must be non-empty.
+    """
+    n = len(tier)
+    return tier.sum() / n, prior_auth.sum() / n * 100, step_therapy.sum() / n * 100
+
 def get_current_requirements(data):
     """
     Calculate current requirements from formulary data
     """
     if len(data) == 0:
         return None
-        
+    
+    avg_tier, prior_auth_percent, step_therapy_percent = requirement_stats(
+        data['TIER_LEVEL_VALUE'].to_numpy(),
+        data['PRIOR_AUTHORIZATION_YN'].to_numpy(),
+        data['STEP_THERAPY_YN'].to_numpy()
+    )
     return {
-        'avg_tier': round(data['TIER_LEVEL_VALUE'].mean(), 2),
-        'prior_auth_percent': round((data['PRIOR_AUTHORIZATION_YN'] == 'Y').mean() * 100, 2),
-        'step_therapy_percent': round((data['STEP_THERAPY_YN'] == 'Y').mean() * 100, 2)
+        'avg_tier': round(avg_tier, 2),
+        'prior_auth_percent': round(prior_auth_percent, 2),
+        'step_therapy_percent': round(step_therapy_percent, 2)
     }
 
 def compare_formulary_periods(old_file, new_file, target_ndc):
@@ -74,38 +270,52 @@ def compare_formulary_periods(old_file, new_file, target_ndc):
     Returns:
         dict: Comparison statistics between the two periods
     """
-    # Load data from both periods
-    old_data = load_formulary_data(old_file, target_ndc)
-    new_data = load_formulary_data(new_file, target_ndc)
+    old_df = read_formulary(old_file)
+    new_df = read_formulary(new_file)
+    id_dtype = shared_category_dtype('FORMULARY_ID', old_df, new_df)
+    old_df['FORMULARY_ID'] = recode(old_df['FORMULARY_ID'], id_dtype)
+    new_df['FORMULARY_ID'] = recode(new_df['FORMULARY_ID'], id_dtype)
+    return compare_formulary_periods_df(old_df, new_df, target_ndc)
+
+def compare_formulary_periods_df(old_df, new_df, target_ndc, old_index=None, new_index=None):
+    """
+    Same as compare_formulary_periods, but operates on formulary DataFrames
+    that have already been loaded with read_formulary. Use this when comparing
+    several NDCs so each file is only parsed once; pass indexes from
+    build_ndc_index to avoid rescanning the NDC column for each one.
+    Recoding both FORMULARY_ID columns to a shared_category_dtype lets
+    the maintained-formulary merge join on category codes.
+    """
+    # Subset data from both periods
+    old_data = filter_ndc(old_df, target_ndc, old_index)
+    new_data = filter_ndc(new_df, target_ndc, new_index)
     
-    # Get sets of formulary IDs
-    old_formularies = set(old_data['FORMULARY_ID'].unique())
-    new_formularies = set(new_data['FORMULARY_ID'].unique())
+    # Keep the first row of each formulary, indexed by FORMULARY_ID
+    metric_cols = ['TIER_LEVEL_VALUE', 'PRIOR_AUTHORIZATION_YN', 'STEP_THERAPY_YN']
+    old_by_form = old_data.drop_duplicates('FORMULARY_ID').set_index('FORMULARY_ID')[metric_cols]
+    new_by_form = new_data.drop_duplicates('FORMULARY_ID').set_index('FORMULARY_ID')[metric_cols]
     
-    # Calculate formulary changes
-    added_formularies = new_formularies - old_formularies
-    removed_formularies = old_formularies - new_formularies
-    maintained_formularies = old_formularies.intersection(new_formularies)
+    # Calculate formulary changes. Each index already holds unique
+    # FORMULARY_IDs, so the set arithmetic runs on the indexes without
+    # building Python sets
+    added_formularies = new_by_form.index.difference(old_by_form.index)
+    removed_formularies = old_by_form.index.difference(new_by_form.index)
     
     # Calculate coverage percentages
-    old_total_formularies = len(pd.read_csv(old_file, delimiter='|')['FORMULARY_ID'].unique())
-    new_total_formularies = len(pd.read_csv(new_file, delimiter='|')['FORMULARY_ID'].unique())
+    old_total_formularies = old_df['FORMULARY_ID'].nunique()
+    new_total_formularies = new_df['FORMULARY_ID'].nunique()
+    
+    # For maintained formularies, pair both periods on the FORMULARY_ID index
+    # and calculate metric changes column-wise
+    paired = old_by_form.join(new_by_form, how='inner', lsuffix='_old', rsuffix='_new')
+    maintained_count = len(paired)
     
-    # For maintained formularies, calculate metric changes
     changes = {
-        'tier_changes': [],
-        'prior_auth_changes': [],
-        'step_therapy_changes': []
+        'tier_changes': paired['TIER_LEVEL_VALUE_new'].to_numpy(dtype=np.int64) - paired['TIER_LEVEL_VALUE_old'].to_numpy(dtype=np.int64),
+        'prior_auth_changes': paired['PRIOR_AUTHORIZATION_YN_new'].to_numpy() != paired['PRIOR_AUTHORIZATION_YN_old'].to_numpy(),
+        'step_therapy_changes': paired['STEP_THERAPY_YN_new'].to_numpy() != paired['STEP_THERAPY_YN_old'].to_numpy()
     }
     
-    for formulary_id in maintained_formularies:
-        old_form = old_data[old_data['FORMULARY_ID'] == formulary_id].iloc[0]
-        new_form = new_data[new_data['FORMULARY_ID'] == formulary_id].iloc[0]
-        
-        changes['tier_changes'].append(new_form['TIER_LEVEL_VALUE'] - old_form['TIER_LEVEL_VALUE'])
-        changes['prior_auth_changes'].append(new_form['PRIOR_AUTHORIZATION_YN'] != old_form['PRIOR_AUTHORIZATION_YN'])
-        changes['step_therapy_changes'].append(new_form['STEP_THERAPY_YN'] != old_form['STEP_THERAPY_YN'])
-    
     # Get current requirements for both periods
     old_requirements = get_current_requirements(old_data)
     new_requirements = get_current_requirements(new_data)
@@ -115,18 +325,18 @@ def compare_formulary_periods(old_file, new_file, target_ndc):
         'formulary_changes': {
             'added': len(added_formularies),
             'removed': len(removed_formularies),
-            'maintained': len(maintained_formularies),
-            'added_list': list(added_formularies),
-            'removed_list': list(removed_formularies)
+            'maintained': maintained_count,
+            'added_list': added_formularies.tolist(),
+            'removed_list': removed_formularies.tolist()
         },
         'metric_changes': {
-            'avg_tier_change': round(sum(changes['tier_changes']) / len(maintained_formularies), 2) if maintained_formularies else 0,
-            'prior_auth_changes': sum(changes['prior_auth_changes']),
-            'step_therapy_changes': sum(changes['step_therapy_changes'])
+            'avg_tier_change': round(changes['tier_changes'].sum() / maintained_count, 2) if maintained_count else 0,
+            'prior_auth_changes': int(changes['prior_auth_changes'].sum()),
+            'step_therapy_changes': int(changes['step_therapy_changes'].sum())
         },
         'coverage': {
-            'old_coverage_percent': round(len(old_formularies) / old_total_formularies * 100, 2),
-            'new_coverage_percent': round(len(new_formularies) / new_total_formularies * 100, 2)
+            'old_coverage_percent': round(len(old_by_form) / old_total_formularies * 100, 2),
+            'new_coverage_percent': round(len(new_by_form) / new_total_formularies * 100, 2)
         },
         'current_requirements': {
             'old': old_requirements,
@@ -142,8 +352,22 @@ if __name__ == "__main__":
     # Example NDC (trying a different one from your sample data)
     test_ndc = '00069197540'
     
+    # Convert each file to Parquet on the first run so later runs skip the text parse
+    for path in (old_file, new_file):
+        if not parquet_is_current(path):
+            write_formulary_parquet(path)
+    
+    # Load and index each file once
+    old_df = read_formulary(old_file)
+    new_df = read_formulary(new_file)
+    id_dtype = shared_category_dtype('FORMULARY_ID', old_df, new_df)
+    old_df['FORMULARY_ID'] = recode(old_df['FORMULARY_ID'], id_dtype)
+    new_df['FORMULARY_ID'] = recode(new_df['FORMULARY_ID'], id_dtype)
+    old_index = build_ndc_index(old_df)
+    new_index = build_ndc_index(new_df)
+    
     # Perform comparison
-    comparison = compare_formulary_periods(old_file, new_file, test_ndc)
+    comparison = compare_formulary_periods_df(old_df, new_df, test_ndc, old_index, new_index)
     
     # Print results
     print(f"\nFormulary Comparison for NDC {comparison['ndc']}:")
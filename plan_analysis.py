@@ -1,254 +1,623 @@
+import codecs
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 
+from formulary_analysis import (
+    build_ndc_index, ndc_rows, parquet_is_current, parquet_path, read_formulary, recode, same_categories,
+    shared_category_dtype, source_stamp, write_formulary_parquet, write_parquet
+)
+
+# Only these plan columns are used downstream; the rest of each file is never read
+PLAN_COLUMNS = ['CONTRACT_ID', 'PLAN_ID', 'FORMULARY_ID', 'CONTRACT_NAME', 'PLAN_NAME']
+
+# Formulary columns summarized for each group of plans
+METRIC_COLUMNS = ['TIER_LEVEL_VALUE', 'PRIOR_AUTHORIZATION_YN', 'STEP_THERAPY_YN']
+
+# Text columns that must not be type-inferred. PLAN_ID and FORMULARY_ID are
+# left to inference (integers), matching how the formulary files are read
+PLAN_COLUMN_TYPES = {'CONTRACT_ID': pa.string(), 'CONTRACT_NAME': pa.string(), 'PLAN_NAME': pa.string()}
+
+# Candidate encodings, in order of preference
+ENCODINGS = ['utf-8', 'latin1', 'cp1252']
+
+# Encoding chosen for each file path, so a file is only sniffed once
+_ENCODING_CACHE = {}
+
+# Bytes per block handed to each of pyarrow's CSV parsing threads
+CSV_BLOCK_SIZE = 64 << 20
+
+# Text-to-Parquet conversions run at once by load_period_data. Each worker
+# holds a whole multi-GB formulary file in memory while sorting it, and
+# pyarrow already parses each file on several threads, so memory rather
+# than cores sets the limit
+CONVERSION_WORKERS = 2
+
+def detect_encoding(path, sample_size=65536):
+    """
+    Picks the first encoding that can decode the start of the file.
+    The result is cached per path.
+    """
+    if path not in _ENCODING_CACHE:
+        with open(path, 'rb') as f:
+            sample = f.read(sample_size)
+        for encoding in ENCODINGS:
+            try:
+                # Incremental decode so a character cut off at the end of the sample isn't an error
+                codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            except UnicodeDecodeError:
+                continue
+            _ENCODING_CACHE[path] = encoding
+            break
+    return _ENCODING_CACHE[path]
+
+def write_plans_parquet(plan_file):
+    """
+    One-time conversion of a plan information text file to a Parquet copy
+    holding only PLAN_COLUMNS.
+    """
+    def read(encoding):
+        return pa_csv.read_csv(
+            plan_file,
+            read_options=pa_csv.ReadOptions(encoding=encoding, block_size=CSV_BLOCK_SIZE),
+            parse_options=pa_csv.ParseOptions(delimiter='|'),
+            convert_options=pa_csv.ConvertOptions(include_columns=PLAN_COLUMNS, column_types=PLAN_COLUMN_TYPES)
+        )
+
+    # Stamp before reading, so a file replaced mid-conversion reads as stale
+    stamp = source_stamp(plan_file)
+    encoding = detect_encoding(plan_file)
+    try:
+        table = read(encoding)
+    except pa.ArrowInvalid as error:
+        # Invalid UTF-8 past the sniffed sample. latin1 decodes any byte, so
+        # one more pass is the most this can cost; any other parse error
+        # would only fail again
+        if encoding != 'utf-8' or 'invalid UTF8' not in str(error):
+            raise
+        _ENCODING_CACHE[plan_file] = 'latin1'
+        table = read('latin1')
+    write_parquet(table, plan_file, stamp, compression='zstd')
+
+@functools.lru_cache(maxsize=8)
 def load_plans_data(plan_file):
     """
     Loads plan information and creates a mapping of formulary ID to plan details.
     Returns a tuple: (plans_df, total_plans_count).
+    Results are cached per path, so treat the returned DataFrame as read-only.
+    The text file is converted to Parquet on first use and read from there.
     """
-    # Try different encodings
-    encodings = ['utf-8', 'latin1', 'cp1252']
-    plans_df = None
-    
-    for encoding in encodings:
-        try:
-            plans_df = pd.read_csv(plan_file, delimiter='|', encoding=encoding)
-            break
-        except UnicodeDecodeError:
-            continue
-        except Exception as e:
-            print(f"Error loading file with {encoding} encoding: {str(e)}")
-            continue
+    if not parquet_is_current(plan_file):
+        write_plans_parquet(plan_file)
+    plans_df = pd.read_parquet(parquet_path(plan_file), columns=PLAN_COLUMNS, engine='pyarrow')
+
+    # Plans repeat once per segment; keep one row per plan so joins on
+    # FORMULARY_ID produce unique plans
+    plans_df = plans_df.drop_duplicates(['CONTRACT_ID', 'PLAN_ID'])
+
+    # Contract, plan and formulary values repeat across plans, so store them
+    # as categories. PLAN_ID only feeds PLAN_KEY and isn't always numeric
+    plans_df = plans_df.astype({
+        'CONTRACT_ID': 'category',
+        'PLAN_ID': 'category',
+        'FORMULARY_ID': 'category',
+        'CONTRACT_NAME': 'category',
+        'PLAN_NAME': 'category'
+    })
 
     # Create a unique plan identifier combining contract and plan ID
-    plans_df['PLAN_KEY'] = plans_df['CONTRACT_ID'].astype(str) + '_' + plans_df['PLAN_ID'].astype(str)
+    contract_ids = plans_df['CONTRACT_ID'].to_numpy(dtype=str)
+    plan_ids = plans_df['PLAN_ID'].to_numpy().astype(str)
+    plan_keys = pd.Categorical(np.char.add(np.char.add(contract_ids, '_'), plan_ids))
+    plans_df = apply_plan_key_dtype(plans_df.assign(PLAN_KEY=plan_keys), plan_keys.dtype)
 
-    total_plans_count = plans_df['PLAN_KEY'].nunique()
+    # The PLAN_KEY categories are exactly the distinct keys, so counting them
+    # doesn't need another pass over the column
+    total_plans_count = plan_keys.categories.size
     return plans_df, total_plans_count
 
-def load_formulary_data(formulary_file):
+def apply_plan_key_dtype(plans_df, dtype):
+    """
+    Returns plans_df with PLAN_KEY cast to the given categorical dtype and
+    PLAN_KEY_CODE holding the matching integer codes, which
+    analyze_plan_changes uses for its set arithmetic.
+    """
+    plan_keys = recode(plans_df['PLAN_KEY'], dtype)
+    return plans_df.assign(PLAN_KEY=plan_keys, PLAN_KEY_CODE=plan_keys.codes)
+
+def index_plans_by_formulary(plans_df):
+    """
+    Indexes (and sorts) plans by FORMULARY_ID so each analysis can look up
+    the plans for a handful of formularies without re-hashing the whole
+    plans table. analyze_plan_changes accepts plans in either form.
+    """
+    # Stable, so plans keep their file order within each formulary
+    return plans_df.set_index('FORMULARY_ID').sort_index(kind='stable')
+
+def formulary_plan_offsets(plans_df):
+    """
+    Maps each FORMULARY_ID to its plans for plans from index_plans_by_formulary
+    with a categorical FORMULARY_ID: the plans of category code c are rows
+    offsets[c]:offsets[c + 1]. Lets the NDC/plan join gather plan rows by
+    position instead of hash-joining DataFrames.
+    """
+    # Plans without a FORMULARY_ID have code -1 and sort last; leave them out
+    # so they don't extend the last formulary's run
+    codes = np.asarray(plans_df.index.codes)
+    codes = codes[:np.count_nonzero(codes >= 0)]
+    return np.searchsorted(codes, np.arange(len(plans_df.index.categories) + 1))
+
+def load_formulary_data(formulary_file, target_ndcs=None):
     """
     Loads the entire formulary data for a given time period.
-    Returns the raw formulary DataFrame.
+    Returns the formulary DataFrame in the read_formulary layout (uint64 NDC,
+    bool PA/ST flags). The text file is converted to Parquet on first use.
     """
-    encodings = ['utf-8', 'latin1', 'cp1252']
-    formulary_df = None
+    if not parquet_is_current(formulary_file):
+        write_formulary_parquet(formulary_file)
+    return read_formulary(formulary_file, target_ndcs=target_ndcs)
 
-    for encoding in encodings:
-        try:
-            formulary_df = pd.read_csv(formulary_file, delimiter='|', encoding=encoding)
-            break
-        except UnicodeDecodeError:
-            continue
-        except Exception as e:
-            print(f"Error loading file with {encoding} encoding: {str(e)}")
-            continue
+def convert_to_parquet(job):
+    """
+    Writes the Parquet copy of one ('plan' or 'formulary', path) job.
+    Top-level so it can run in a worker process.
+    """
+    kind, path = job
+    if kind == 'plan':
+        write_plans_parquet(path)
+    else:
+        write_formulary_parquet(path)
+
+def load_period_data(file_paths, time_periods, max_workers=CONVERSION_WORKERS, target_ndcs=None):
+    """
+    Loads each period's plan and formulary data into memory once.
+    Returns a dict of period -> {'plans_df', 'total_plans', 'formulary_df', 'ndc_index', 'plan_offsets', 'loaded_ndcs'}.
+    Files without a current Parquet copy are converted first, max_workers at a time.
     
-    return formulary_df
+    Passing target_ndcs keeps only those NDCs' formulary rows; the filter is
+    pushed into the Parquet scan so the full formulary is never materialized.
+    loaded_ndcs records them (as integers; None when every NDC was loaded) so
+    analyzing any other NDC fails instead of reporting no coverage.
+    """
+    loaded_ndcs = frozenset(int(ndc) for ndc in target_ndcs) if target_ndcs is not None else None
 
-def analyze_plan_changes(
-    old_formulary_df, old_plans_df, old_total_plans,
-    new_formulary_df, new_plans_df, new_total_plans,
-    target_ndc
+    # Parsing the text files dominates the load, so convert any that lack a
+    # current Parquet copy in parallel worker processes. The workers return
+    # nothing; the frames are read back from Parquet below, in this process,
+    # so no large DataFrames are pickled between processes. Periods can share
+    # a file, so each stale path is queued once; two workers must never write
+    # the same Parquet copy
+    pending = list(dict.fromkeys(
+        (kind, file_paths[period][kind])
+        for period in time_periods
+        for kind in ('plan', 'formulary')
+        if not parquet_is_current(file_paths[period][kind])
+    ))
+    if pending:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(convert_to_parquet, pending))
+
+    period_data = {}
+
+    for period in time_periods:
+        plan_file = file_paths[period]['plan']
+        formulary_file = file_paths[period]['formulary']
+        
+        # Load plan data
+        plans_df, total_plan_count = load_plans_data(plan_file)
+        
+        # Load formulary data
+        formulary_df = load_formulary_data(formulary_file, target_ndcs)
+        
+        # Share FORMULARY_ID categories between the two so merges join on codes.
+        # plans_df is cached by load_plans_data, so cast a copy rather than in place
+        id_dtype = shared_category_dtype('FORMULARY_ID', formulary_df, plans_df)
+        formulary_df['FORMULARY_ID'] = recode(formulary_df['FORMULARY_ID'], id_dtype)
+        plans_df = index_plans_by_formulary(plans_df.assign(FORMULARY_ID=recode(plans_df['FORMULARY_ID'], id_dtype)))
+        
+        # Store in dictionary, with plans indexed by FORMULARY_ID, an
+        # NDC -> row positions index and a FORMULARY_ID -> plan rows map, so
+        # each drug's subset and plan lookup avoid scanning or re-hashing the
+        # full tables
+        period_data[period] = {
+            'plans_df': plans_df,
+            'total_plans': total_plan_count,
+            'formulary_df': formulary_df,
+            'ndc_index': build_ndc_index(formulary_df),
+            'plan_offsets': formulary_plan_offsets(plans_df),
+            'loaded_ndcs': loaded_ndcs
+        }
+
+    # Give every period's PLAN_KEY the same categories so plan codes can be
+    # compared across periods without re-hashing the keys
+    key_dtype = shared_category_dtype('PLAN_KEY', *(period_data[period]['plans_df'] for period in time_periods))
+    for period in time_periods:
+        period_data[period]['plans_df'] = apply_plan_key_dtype(period_data[period]['plans_df'], key_dtype)
+
+    return period_data
+
+def _join_ndc_plans(data, target_ndcs):
+    """
+    Joins one period's formulary rows for target_ndcs to its plans.
+    Returns the joined DataFrame and each row's position in target_ndcs.
+    """
+    loaded_ndcs = data.get('loaded_ndcs')
+    if loaded_ndcs is not None:
+        missing = [ndc for ndc in target_ndcs if int(ndc) not in loaded_ndcs]
+        if missing:
+            raise ValueError(f"NDCs {missing} were not loaded; pass them to load_period_data's target_ndcs")
+    formulary_df = data['formulary_df']
+    plans_df = data['plans_df']
+    if plans_df.index.name != 'FORMULARY_ID':
+        plans_df = index_plans_by_formulary(plans_df)
+
+    # Find the formulary rows for the target NDCs, tagging each row with its
+    # NDC's position. NDC is stored as uint64 at load time, so these are
+    # integer lookups with no per-row string padding
+    rows = [ndc_rows(formulary_df, ndc, data.get('ndc_index')) for ndc in target_ndcs]
+    ndc_pos = np.repeat(np.arange(len(target_ndcs)), [len(r) for r in rows])
+    rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+
+    plan_offsets = data.get('plan_offsets')
+    if plan_offsets is not None and same_categories(formulary_df['FORMULARY_ID'].dtype, plans_df.index.dtype):
+        return _gather_ndc_plans(formulary_df, plans_df, plan_offsets, rows, ndc_pos)
+
+    subset = formulary_df.take(rows)
+    subset['NDC_POS'] = ndc_pos
+
+    # Join plan information on FORMULARY_ID. plans_df already has one row per
+    # plan, so keeping the first formulary row per (NDC, FORMULARY_ID) makes
+    # the joined PLAN_KEYs unique per NDC without deduplicating the joined frame
+    merged = subset.drop_duplicates(['NDC_POS', 'FORMULARY_ID']).join(plans_df, on='FORMULARY_ID', how='inner')
+    return merged, merged['NDC_POS'].to_numpy(dtype=np.int64)
+
+def _gather_ndc_plans(formulary_df, plans_df, plan_offsets, rows, ndc_pos):
+    """
+    _join_ndc_plans for formulary and plans sharing a FORMULARY_ID dtype,
+    using the formulary_plan_offsets map instead of a DataFrame join.
+    """
+    form_codes = np.asarray(formulary_df['FORMULARY_ID'].cat.codes, dtype=np.int64)[rows]
+    known = form_codes >= 0
+    rows, ndc_pos, form_codes = rows[known], ndc_pos[known], form_codes[known]
+
+    # Keep the first formulary row per (NDC, FORMULARY_ID), in formulary
+    # order, so the joined PLAN_KEYs are unique per NDC
+    _, first = np.unique(ndc_pos * (len(plan_offsets) - 1) + form_codes, return_index=True)
+    first.sort()
+    rows, ndc_pos, form_codes = rows[first], ndc_pos[first], form_codes[first]
+
+    # Expand each formulary row into the contiguous run of plan rows for its
+    # FORMULARY_ID
+    starts = plan_offsets[form_codes]
+    counts = plan_offsets[form_codes + 1] - starts
+    left = np.repeat(np.arange(len(rows)), counts)
+    plan_rows = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+
+    merged = plans_df.take(plan_rows).assign(
+        **{col: formulary_df[col].to_numpy()[rows[left]] for col in METRIC_COLUMNS},
+        NDC_POS=ndc_pos[left]
+    )
+    return merged, ndc_pos[left].astype(np.int64)
+
+def _prepare_ndc_plans(data, target_ndcs):
+    """
+    Everything analyze_all_drugs needs from one period on its own: the
+    _join_ndc_plans result plus its plan codes, tier/PA/ST block, and
+    per-NDC plan counts and metrics.
+    """
+    merged, pos = _join_ndc_plans(data, target_ndcs)
+    values = merged[METRIC_COLUMNS].to_numpy(dtype=np.int64)
+    counts, metrics = _grouped_metrics(values, pos, len(target_ndcs))
+    return {
+        'merged': merged,
+        'pos': pos,
+        'plan_codes': merged['PLAN_KEY_CODE'].to_numpy(dtype=np.int64) if 'PLAN_KEY_CODE' in merged else None,
+        'values': values,
+        'counts': counts,
+        'metrics': metrics
+    }
+
+def _grouped_metrics(values, positions, n_groups):
+    """
+    Calculate tier, PA, and ST metrics for each group of rows. positions must
+    be non-decreasing, i.e. each group's rows are contiguous.
+    """
+    # One cumulative sum over the integer block gives every group's three
+    # sums as differences at the group bounds; the bool PA/ST flags sum to
+    # the number of plans requiring them
+    bounds = np.searchsorted(positions, np.arange(n_groups + 1))
+    totals = np.concatenate([np.zeros((1, 3), dtype=np.int64), values.cumsum(axis=0)])
+    counts = np.diff(bounds)
+    sums = totals[bounds[1:]] - totals[bounds[:-1]]
+    metrics = []
+    for n, (tier_sum, pa_sum, st_sum) in zip(counts, sums):
+        if n == 0:
+            metrics.append({'avg_tier': 0.0, 'pa_percent': 0.0, 'st_percent': 0.0})
+        else:
+            metrics.append({'avg_tier': tier_sum / n, 'pa_percent': pa_sum / n * 100, 'st_percent': st_sum / n * 100})
+    return counts, metrics
+
+def _round_metrics(metrics):
+    return {name: round(value, 1) for name, value in metrics.items()}
+
+def analyze_all_drugs(
+    old_data, new_data, target_ndcs, detail_limit=5, return_details=False,
+    old_joined=None, new_joined=None
 ):
     """
-    Analyzes changes in plan coverage between two time periods for a specific NDC,
-    using in-memory DataFrames rather than reading from disk.
+    Analyzes changes in plan coverage between two time periods for every NDC
+    in target_ndcs at once. old_data/new_data are period_data entries as
+    returned by load_period_data.
     
-    Returns a dictionary containing plan changes, metrics, and coverage information.
+    All NDCs are joined to plans in one pass and compared as combined
+    (NDC, plan) integer keys, so the set arithmetic and metric sums run once
+    per period pair rather than once per drug.
+    
+    old_joined/new_joined are optional _prepare_ndc_plans results for the
+    two periods and the same (duplicate-free) target_ndcs, for callers that
+    compare one period against several others. With them, only the pairwise
+    key lookup and the maintained/added sums are left to compute here.
+    
+    Returns a dictionary of NDC -> the analyze_plan_changes result for it.
     """
+    target_ndcs = list(dict.fromkeys(target_ndcs))
+    n_ndcs = len(target_ndcs)
 
-    # Subset the formulary data for the specified NDC (zfill to ensure consistent 11-digit NDC)
-    target_ndc_str = str(target_ndc).zfill(11)
-    old_data = old_formulary_df[old_formulary_df['NDC'].astype(str).str.zfill(11) == target_ndc_str]
-    new_data = new_formulary_df[new_formulary_df['NDC'].astype(str).str.zfill(11) == target_ndc_str]
+    old = old_joined if old_joined is not None else _prepare_ndc_plans(old_data, target_ndcs)
+    new = new_joined if new_joined is not None else _prepare_ndc_plans(new_data, target_ndcs)
+    old_merged, old_pos, old_values = old['merged'], old['pos'], old['values']
+    new_merged, new_pos, new_values = new['merged'], new['pos'], new['values']
 
-    # Merge with plan information on FORMULARY_ID, then drop duplicates by PLAN_KEY
-    old_merged = pd.merge(old_data, old_plans_df, on='FORMULARY_ID', how='inner').drop_duplicates('PLAN_KEY')
-    new_merged = pd.merge(new_data, new_plans_df, on='FORMULARY_ID', how='inner').drop_duplicates('PLAN_KEY')
+    # Get plan identifiers as integer codes so the set arithmetic doesn't hash strings
+    old_key_dtype = old_merged['PLAN_KEY'].dtype
+    if same_categories(old_key_dtype, new_merged['PLAN_KEY'].dtype):
+        # Both periods share PLAN_KEY categories (see load_period_data), so the
+        # codes computed at load time already line up
+        old_codes = old['plan_codes']
+        new_codes = new['plan_codes']
+        n_codes = len(old_key_dtype.categories)
+    else:
+        codes, uniques = pd.factorize(np.concatenate([old_merged['PLAN_KEY'].to_numpy(), new_merged['PLAN_KEY'].to_numpy()]))
+        old_codes = codes[:len(old_merged)].astype(np.int64)
+        new_codes = codes[len(old_merged):].astype(np.int64)
+        n_codes = len(uniques)
 
-    # Get unique plan identifiers
-    old_plans = set(old_merged['PLAN_KEY'])
-    new_plans = set(new_merged['PLAN_KEY'])
+    # One key per (NDC, plan); unique within each side after the join
+    old_keys = old_pos * max(n_codes, 1) + old_codes
+    new_keys = new_pos * max(n_codes, 1) + new_codes
 
-    # Calculate plan changes
-    added_plans = new_plans - old_plans
-    removed_plans = old_plans - new_plans
-    maintained_plans = old_plans.intersection(new_plans)
+    # Calculate plan changes with one hash lookup of the new keys among the
+    # old ones: -1 marks an added plan, anything else is the old row of a
+    # maintained plan. Old rows nobody matched were removed
+    old_rows_of_new = pd.Index(old_keys).get_indexer(new_keys)
+    added_mask = old_rows_of_new < 0
+    new_maintained_rows = np.flatnonzero(~added_mask)
+    old_maintained_rows = old_rows_of_new[new_maintained_rows]
+    removed_mask = np.ones(len(old_keys), dtype=bool)
+    removed_mask[old_maintained_rows] = False
+    removed_counts = np.bincount(old_pos[removed_mask], minlength=n_ndcs)
 
-    # Prepare details for added/removed plans
-    added_plan_details = new_merged[new_merged['PLAN_KEY'].isin(added_plans)][
-        ['PLAN_KEY', 'CONTRACT_NAME', 'PLAN_NAME']
-    ].to_dict('records')
-    
-    removed_plan_details = old_merged[old_merged['PLAN_KEY'].isin(removed_plans)][
-        ['PLAN_KEY', 'CONTRACT_NAME', 'PLAN_NAME']
-    ].to_dict('records')
-
-    def calculate_metrics(df):
-        """Calculate tier, PA, and ST metrics for a given DataFrame"""
-        if len(df) == 0:
-            return {
-                'avg_tier': 0.0,
-                'pa_percent': 0.0,
-                'st_percent': 0.0
-            }
-        return {
-            'avg_tier': df['TIER_LEVEL_VALUE'].sum() / len(df),
-            'pa_percent': (df['PRIOR_AUTHORIZATION_YN'] == 'Y').sum() / len(df) * 100,
-            'st_percent': (df['STEP_THERAPY_YN'] == 'Y').sum() / len(df) * 100
-        }
+    # Calculate metrics for maintained plans and added plans; the all-plans
+    # metrics only depend on one period and were computed with its join.
+    # The maintained row positions pair each plan's old and new rows, so the
+    # columns can be compared as raw arrays
+    maintained_pos = new_pos[new_maintained_rows]
+    old_maintained = old_values[old_maintained_rows]
+    new_maintained = new_values[new_maintained_rows]
 
-    # Calculate metrics for all plans that cover the drug
-    old_metrics = calculate_metrics(old_merged)
-    new_metrics = calculate_metrics(new_merged)
+    old_counts, old_metrics = old['counts'], old['metrics']
+    new_counts, new_metrics = new['counts'], new['metrics']
+    maintained_counts, maintained_old_metrics = _grouped_metrics(old_maintained, maintained_pos, n_ndcs)
+    _, maintained_new_metrics = _grouped_metrics(new_maintained, maintained_pos, n_ndcs)
+    added_counts, added_metrics = _grouped_metrics(new_values[added_mask], new_pos[added_mask], n_ndcs)
 
-    # Calculate metrics for maintained plans
-    if maintained_plans:
-        old_maintained = old_merged[old_merged['PLAN_KEY'].isin(maintained_plans)].set_index('PLAN_KEY').sort_index()
-        new_maintained = new_merged[new_merged['PLAN_KEY'].isin(maintained_plans)].set_index('PLAN_KEY').sort_index()
+    # PA/ST changes compare the same gathered maintained rows, so no column
+    # is gathered twice
+    flag_changes = old_maintained[:, 1:] != new_maintained[:, 1:]
+    pa_change_counts = np.bincount(maintained_pos[flag_changes[:, 0]], minlength=n_ndcs)
+    st_change_counts = np.bincount(maintained_pos[flag_changes[:, 1]], minlength=n_ndcs)
 
-        maintained_old_metrics = calculate_metrics(old_maintained)
-        maintained_new_metrics = calculate_metrics(new_maintained)
+    if return_details:
+        # The joined rows are grouped by NDC position, so each NDC's added and
+        # removed rows are a contiguous run of these row positions and the
+        # details only gather the rows they show
+        added_rows = np.flatnonzero(added_mask)
+        removed_rows = np.flatnonzero(removed_mask)
+        added_bounds = np.searchsorted(new_pos[added_rows], np.arange(n_ndcs + 1))
+        removed_bounds = np.searchsorted(old_pos[removed_rows], np.arange(n_ndcs + 1))
+        detail_cols = ['PLAN_KEY', 'CONTRACT_NAME', 'PLAN_NAME']
 
-        pa_changes = (new_maintained['PRIOR_AUTHORIZATION_YN'] != old_maintained['PRIOR_AUTHORIZATION_YN'])
-        st_changes = (new_maintained['STEP_THERAPY_YN'] != old_maintained['STEP_THERAPY_YN'])
-    else:
-        maintained_old_metrics = {'avg_tier': 0, 'pa_percent': 0, 'st_percent': 0}
-        maintained_new_metrics = {'avg_tier': 0, 'pa_percent': 0, 'st_percent': 0}
-        pa_changes = pd.Series([], dtype=bool)
-        st_changes = pd.Series([], dtype=bool)
-
-    # Calculate metrics for added plans
-    added_data = new_merged[new_merged['PLAN_KEY'].isin(added_plans)]
-    added_metrics = calculate_metrics(added_data)
-
-    metric_changes = {
-        'all_plans': {
-            'old': {
-                'avg_tier': round(old_metrics['avg_tier'], 1),
-                'pa_percent': round(old_metrics['pa_percent'], 1),
-                'st_percent': round(old_metrics['st_percent'], 1)
+    old_total_plans = old_data['total_plans']
+    new_total_plans = new_data['total_plans']
+
+    results = {}
+    for i, target_ndc in enumerate(target_ndcs):
+        # Prepare details for added/removed plans, limited to the rows callers show
+        if return_details:
+            added_data = new_merged.take(added_rows[added_bounds[i]:added_bounds[i + 1]][:detail_limit])
+            removed_data = old_merged.take(removed_rows[removed_bounds[i]:removed_bounds[i + 1]][:detail_limit])
+            added_plan_details = added_data[detail_cols].to_dict('records')
+            removed_plan_details = removed_data[detail_cols].to_dict('records')
+        else:
+            added_plan_details = None
+            removed_plan_details = None
+
+        if maintained_counts[i] > 0:
+            maintained_old = maintained_old_metrics[i]
+            maintained_new = maintained_new_metrics[i]
+        else:
+            maintained_old = {'avg_tier': 0, 'pa_percent': 0, 'st_percent': 0}
+            maintained_new = {'avg_tier': 0, 'pa_percent': 0, 'st_percent': 0}
+
+        # Coverage = fraction of total plans that cover the drug
+        old_coverage_percent = (old_counts[i] / old_total_plans * 100) if old_total_plans > 0 else 0
+        new_coverage_percent = (new_counts[i] / new_total_plans * 100) if new_total_plans > 0 else 0
+
+        results[target_ndc] = {
+            'ndc': target_ndc,
+            'plan_changes': {
+                'added': int(added_counts[i]),
+                'removed': int(removed_counts[i]),
+                'maintained': int(maintained_counts[i]),
+                'added_details': added_plan_details,
+                'removed_details': removed_plan_details
             },
-            'new': {
-                'avg_tier': round(new_metrics['avg_tier'], 1),
-                'pa_percent': round(new_metrics['pa_percent'], 1),
-                'st_percent': round(new_metrics['st_percent'], 1)
-            }
-        },
-        'maintained_plans': {
-            'old': {
-                'avg_tier': round(maintained_old_metrics['avg_tier'], 1),
-                'pa_percent': round(maintained_old_metrics['pa_percent'], 1),
-                'st_percent': round(maintained_old_metrics['st_percent'], 1)
+            'metric_changes': {
+                'all_plans': {
+                    'old': _round_metrics(old_metrics[i]),
+                    'new': _round_metrics(new_metrics[i])
+                },
+                'maintained_plans': {
+                    'old': _round_metrics(maintained_old),
+                    'new': _round_metrics(maintained_new)
+                },
+                'added_plans': _round_metrics(added_metrics[i]),
+                'changes': {
+                    'prior_auth_changes': pa_change_counts[i],
+                    'step_therapy_changes': st_change_counts[i]
+                }
             },
-            'new': {
-                'avg_tier': round(maintained_new_metrics['avg_tier'], 1),
-                'pa_percent': round(maintained_new_metrics['pa_percent'], 1),
-                'st_percent': round(maintained_new_metrics['st_percent'], 1)
+            'coverage': {
+                'old_coverage_percent': round(old_coverage_percent, 2),
+                'new_coverage_percent': round(new_coverage_percent, 2)
+            },
+            'total_plans': {
+                'old': old_total_plans,
+                'new': new_total_plans
             }
-        },
-        'added_plans': {
-            'avg_tier': round(added_metrics['avg_tier'], 1),
-            'pa_percent': round(added_metrics['pa_percent'], 1),
-            'st_percent': round(added_metrics['st_percent'], 1)
-        },
-        'changes': {
-            'prior_auth_changes': pa_changes.sum(),
-            'step_therapy_changes': st_changes.sum()
         }
-    }
 
-    # Coverage = fraction of total plans that cover the drug
-    old_coverage_percent = (len(old_plans) / old_total_plans * 100) if old_total_plans > 0 else 0
-    new_coverage_percent = (len(new_plans) / new_total_plans * 100) if new_total_plans > 0 else 0
+    return results
 
-    return {
-        'ndc': target_ndc,
-        'plan_changes': {
-            'added': len(added_plans),
-            'removed': len(removed_plans),
-            'maintained': len(maintained_plans),
-            'added_details': added_plan_details,
-            'removed_details': removed_plan_details
-        },
-        'metric_changes': metric_changes,
-        'coverage': {
-            'old_coverage_percent': round(old_coverage_percent, 2),
-            'new_coverage_percent': round(new_coverage_percent, 2)
-        },
-        'total_plans': {
-            'old': old_total_plans,
-            'new': new_total_plans
-        }
-    }
+def analyze_plan_changes(
+    old_formulary_df, old_plans_df, old_total_plans,
+    new_formulary_df, new_plans_df, new_total_plans,
+    target_ndc, detail_limit=5, return_details=False,
+    old_ndc_index=None, new_ndc_index=None
+):
+    """
+    Analyzes changes in plan coverage between two time periods for a specific NDC,
+    using in-memory DataFrames rather than reading from disk.
+    
+    Added/removed plan detail records are only built when return_details is
+    True; otherwise they are None. Only the first detail_limit plans are
+    included (pass None for all of them). The counts always cover every plan.
+    
+    old_ndc_index/new_ndc_index are optional build_ndc_index results for the
+    two formularies; with them the NDC subset is a lookup instead of a scan.
+    Plans already passed through index_plans_by_formulary are joined by
+    index lookup; plain plans DataFrames are indexed on the fly.
+    
+    This is analyze_all_drugs for a single NDC; use that directly when
+    comparing several NDCs across the same two periods.
+    
+    Returns a dictionary containing plan changes, metrics, and coverage information.
+    """
+    old_data = {'formulary_df': old_formulary_df, 'plans_df': old_plans_df, 'total_plans': old_total_plans, 'ndc_index': old_ndc_index}
+    new_data = {'formulary_df': new_formulary_df, 'plans_df': new_plans_df, 'total_plans': new_total_plans, 'ndc_index': new_ndc_index}
+    return analyze_all_drugs(old_data, new_data, [target_ndc], detail_limit, return_details)[target_ndc]
 
-def collect_metrics_by_period(period_data, time_periods, drug_mapping):
+def collect_metrics_by_period(period_data, time_periods, drug_mapping, max_workers=None):
     """
     Collects comparison data into a DataFrame for plotting analysis.
+    Every drug is compared in one analyze_all_drugs call per period pair,
+    and the pairs run on a thread pool of max_workers threads
+    (ThreadPoolExecutor's default when None).
+    Rows are ordered by drug name, NDC, then period in time_periods order.
     """
-    # Create lists to store the metrics for each time period and drug
-    metrics_data = []
-    
-    # For each drug
-    for drug_name, ndcs in drug_mapping.items():
-        for ndc in ndcs:
-            # For each consecutive pair of time periods
-            for i in range(len(time_periods) - 1):
-                old_period = time_periods[i]
-                new_period = time_periods[i + 1]
-                
-                # Get data for old and new periods
-                old_data = period_data[old_period]
-                new_data = period_data[new_period]
-                
-                # Analyze changes between periods
-                comparison = analyze_plan_changes(
-                    old_data['formulary_df'], old_data['plans_df'], old_data['total_plans'],
-                    new_data['formulary_df'], new_data['plans_df'], new_data['total_plans'],
-                    ndc
+    all_ndcs = list(dict.fromkeys(ndc for ndcs in drug_mapping.values() for ndc in ndcs))
+
+    def join(period):
+        return _prepare_ndc_plans(period_data[period], all_ndcs)
+
+    def compare(pair):
+        old_period, new_period = pair
+        return analyze_all_drugs(
+            period_data[old_period], period_data[new_period], all_ndcs,
+            old_joined=joined[old_period], new_joined=joined[new_period]
+        )
+
+    # Every inner period is the new side of one pair and the old side of the
+    # next, so join each period's drugs to its plans and summarize them once
+    # up front; the pairs then only diff plan keys. Both steps
+    # only read the shared period DataFrames, so they run concurrently
+    pairs = list(zip(time_periods[:-1], time_periods[1:]))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        joined = dict(zip(time_periods, executor.map(join, time_periods)))
+        comparisons = dict(zip(pairs, executor.map(compare, pairs)))
+
+    # Preallocate one typed array per column. Every drug/NDC gets a row for
+    # the first period plus one per consecutive pair. Drugs and NDCs are
+    # visited in sorted order and periods in time_periods order, so the rows
+    # come out already ordered and need no sort afterwards
+    entries = [(drug_name, ndc) for drug_name in sorted(drug_mapping) for ndc in sorted(drug_mapping[drug_name])]
+    n_rows = len(entries) * len(time_periods) if len(time_periods) > 1 else 0
+    columns = {
+        'drug': np.empty(n_rows, dtype=object),
+        'ndc': np.empty(n_rows, dtype=object),
+        'period': np.empty(n_rows, dtype=object),
+        'coverage': np.empty(n_rows, dtype=np.float64),
+        'total_plans': np.empty(n_rows, dtype=np.int64),
+        'maintained_plans': np.empty(n_rows, dtype=np.int64),
+        'added_plans': np.empty(n_rows, dtype=np.int64),
+        'removed_plans': np.empty(n_rows, dtype=np.int64),
+        'avg_tier': np.empty(n_rows, dtype=np.float64),
+        'pa_percent': np.empty(n_rows, dtype=np.float64),
+        'st_percent': np.empty(n_rows, dtype=np.float64)
+    }
+
+    def set_row(row, drug_name, ndc, period, coverage, total_plans, plan_changes, plan_metrics):
+        columns['drug'][row] = drug_name
+        columns['ndc'][row] = ndc
+        columns['period'][row] = period
+        columns['coverage'][row] = coverage
+        columns['total_plans'][row] = total_plans
+        columns['maintained_plans'][row] = plan_changes['maintained']
+        columns['added_plans'][row] = plan_changes['added']
+        columns['removed_plans'][row] = plan_changes['removed']
+        columns['avg_tier'][row] = plan_metrics['avg_tier']
+        columns['pa_percent'][row] = plan_metrics['pa_percent']
+        columns['st_percent'][row] = plan_metrics['st_percent']
+
+    # No previous period to maintain, add or remove plans from
+    no_changes = {'maintained': 0, 'added': 0, 'removed': 0}
+
+    row = 0
+    for drug_name, ndc in entries:
+        # For each consecutive pair of time periods
+        for i in range(len(time_periods) - 1):
+            old_period = time_periods[i]
+            new_period = time_periods[i + 1]
+
+            # Changes between periods, computed above
+            comparison = comparisons[(old_period, new_period)][ndc]
+
+            # Also include metrics for the first period
+            if i == 0:
+                set_row(
+                    row, drug_name, ndc, old_period,
+                    comparison['coverage']['old_coverage_percent'],
+                    comparison['total_plans']['old'],
+                    no_changes,
+                    comparison['metric_changes']['all_plans']['old']
                 )
-                
-                # Extract metrics for the new period
-                metrics = {
-                    'drug': drug_name,
-                    'ndc': ndc,
-                    'period': new_period,
-                    'coverage': comparison['coverage']['new_coverage_percent'],
-                    'total_plans': comparison['total_plans']['new'],
-                    'maintained_plans': comparison['plan_changes']['maintained'],
-                    'added_plans': comparison['plan_changes']['added'],
-                    'removed_plans': comparison['plan_changes']['removed'],
-                    'avg_tier': comparison['metric_changes']['all_plans']['new']['avg_tier'],
-                    'pa_percent': comparison['metric_changes']['all_plans']['new']['pa_percent'],
-                    'st_percent': comparison['metric_changes']['all_plans']['new']['st_percent']
-                }
-                
-                # Also include metrics for the first period
-                if i == 0:
-                    first_metrics = {
-                        'drug': drug_name,
-                        'ndc': ndc,
-                        'period': old_period,
-                        'coverage': comparison['coverage']['old_coverage_percent'],
-                        'total_plans': comparison['total_plans']['old'],
-                        'maintained_plans': 0,  # No previous period to maintain from
-                        'added_plans': 0,      # No previous period to add from
-                        'removed_plans': 0,    # No previous period to remove from
-                        'avg_tier': comparison['metric_changes']['all_plans']['old']['avg_tier'],
-                        'pa_percent': comparison['metric_changes']['all_plans']['old']['pa_percent'],
-                        'st_percent': comparison['metric_changes']['all_plans']['old']['st_percent']
-                    }
-                    metrics_data.append(first_metrics)
-                
-                metrics_data.append(metrics)
-    
+                row += 1
+
+            # Extract metrics for the new period
+            set_row(
+                row, drug_name, ndc, new_period,
+                comparison['coverage']['new_coverage_percent'],
+                comparison['total_plans']['new'],
+                comparison['plan_changes'],
+                comparison['metric_changes']['all_plans']['new']
+            )
+            row += 1
+
     # Convert to DataFrame
-    metrics_df = pd.DataFrame(metrics_data)
-    
-    # Sort by drug name, NDC, and period for consistent ordering
-    metrics_df = metrics_df.sort_values(['drug', 'ndc', 'period'])
-    
-    return metrics_df
+    return pd.DataFrame(columns)
 
 if __name__ == "__main__":
     # Define file paths in a dictionary
@@ -293,24 +662,9 @@ if __name__ == "__main__":
     # ------------------------------------------------------------------------------
     # 1) LOAD EACH PERIOD'S DATA INTO MEMORY JUST ONCE
     # ------------------------------------------------------------------------------
-    period_data = {}
-
-    for period in time_periods:
-        plan_file = file_paths[period]['plan']
-        formulary_file = file_paths[period]['formulary']
-        
-        # Load plan data
-        plans_df, total_plan_count = load_plans_data(plan_file)
-        
-        # Load formulary data
-        formulary_df = load_formulary_data(formulary_file)
-        
-        # Store in dictionary
-        period_data[period] = {
-            'plans_df': plans_df,
-            'total_plans': total_plan_count,
-            'formulary_df': formulary_df
-        }
+    # Only the mapped drugs are analyzed, so only their formulary rows are loaded
+    target_ndcs = sorted({ndc for ndcs in drug_mapping.values() for ndc in ndcs})
+    period_data = load_period_data(file_paths, time_periods, target_ndcs=target_ndcs)
 
     print("\n" + "="*100)
     print("SEQUENTIAL FORMULARY COVERAGE ANALYSIS")